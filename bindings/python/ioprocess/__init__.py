@@ -1,15 +1,18 @@
+import functools
 import itertools
+import io
 import os
-from select import poll, \
-    POLLERR, POLLHUP, POLLPRI, POLLOUT, POLLIN, POLLWRBAND, \
-    error
+from select import epoll, \
+    EPOLLERR, EPOLLHUP, EPOLLPRI, EPOLLOUT, EPOLLIN, EPOLLWRBAND, \
+    EPOLLET, error
 from threading import Thread, Event, Lock, current_thread
 import fcntl
 import json
 from struct import Struct
 import logging
 import errno
-from collections import namedtuple
+import re
+from collections import deque, namedtuple
 from base64 import b64decode, b64encode
 import stat
 import signal
@@ -28,8 +31,22 @@ try:
 except ImportError:
     pthread = None
 
-Queue = six.moves.queue.Queue
-Empty = six.moves.queue.Empty
+try:
+    # orjson serializes to and parses from bytes directly, avoiding an
+    # encode/decode pass over every message.
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf8')
+
+    def _json_loads(data):
+        return json.loads(bytes(data).decode('utf8'))
 
 elapsed_time = lambda: os.times()[4]  # The system's monotonic timer
 
@@ -40,12 +57,38 @@ Size = Struct("@Q")
 ARGTYPE_STRING = 1
 ARGTYPE_NUMBER = 2
 
-ERROR_FLAGS = POLLERR | POLLHUP
-INPUT_READY_FLAGS = POLLIN | POLLPRI | ERROR_FLAGS
-OUTPUT_READY_FLAGS = POLLOUT | POLLWRBAND | ERROR_FLAGS
+ERROR_FLAGS = EPOLLERR | EPOLLHUP
+INPUT_READY_FLAGS = EPOLLIN | EPOLLPRI | ERROR_FLAGS
+OUTPUT_READY_FLAGS = EPOLLOUT | EPOLLWRBAND | ERROR_FLAGS
 
 ERR_IOPROCESS_CRASH = 100001
 
+# A single writev takes at most IOV_MAX iovecs and fails with EINVAL
+# beyond that, so the sender must cap its slices; a long command queue
+# drained in one wakeup can easily exceed the limit.
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024  # The value on Linux.
+
+# os.eventfd is available since python 3.10.
+_HAVE_EVENTFD = hasattr(os, "eventfd")
+
+# Memoized; os.strerror calls into libc on every error otherwise.
+_strerror = functools.lru_cache(maxsize=256)(os.strerror)
+
+# Log lines from the child have the form "LEVEL|domain|message".
+_LOG_LINE_RE = re.compile(rb"(ERROR|WARNING|DEBUG|INFO)\|[^|]*\|(.*)")
+
+_LOG_METHODS = {
+    b"ERROR": ("error", logging.ERROR),
+    b"WARNING": ("warning", logging.WARNING),
+    b"DEBUG": ("debug", logging.DEBUG),
+    b"INFO": ("info", logging.INFO),
+}
+
 StatResult = namedtuple("StatResult", "st_mode, st_ino, st_dev, st_nlink,"
                                       "st_uid, st_gid, st_size, st_atime,"
                                       "st_mtime, st_ctime, st_blocks")
@@ -77,7 +120,7 @@ def _communicate(ioproc_ref, proc, readPipe, writePipe):
 
     err = proc.stderr.fileno()
 
-    poller = poll()
+    poller = epoll()
 
     # When closing the ioprocess there might be race for closing this fd
     # using a copy solves this
@@ -91,12 +134,17 @@ def _communicate(ioproc_ref, proc, readPipe, writePipe):
         poller.register(err, INPUT_READY_FLAGS)
         poller.register(evtReciever, INPUT_READY_FLAGS)
         poller.register(readPipe, INPUT_READY_FLAGS)
-        poller.register(writePipe, ERROR_FLAGS)
+        # Registered once, edge-triggered; we get an EPOLLOUT edge when
+        # the pipe becomes writable again after filling up, instead of
+        # paying an epoll_ctl syscall to toggle the mask per request.
+        poller.register(writePipe, OUTPUT_READY_FLAGS | EPOLLET)
 
         while True:
             real_ioproc = None
 
-            pollres = NoIntrPoll(poller.poll, 5)
+            # Wait indefinitely; close() wakes us up through the event
+            # fd, so the old 5 second periodic wake was redundant.
+            pollres = NoIntrPoll(poller.poll)
 
             real_ioproc = ioproc_ref()
             if real_ioproc is None:
@@ -118,42 +166,59 @@ def _communicate(ioproc_ref, proc, readPipe, writePipe):
                     continue
 
                 if fd == readPipe:
-                    if not responseReader.process():
-                        return
-
-                    res = responseReader.pop()
-                    reqId = res['id']
-                    pendingReq = pendingRequests.pop(reqId, None)
-                    if pendingReq is not None:
-                        pendingReq.result = res
-                        pendingReq.event.set()
-                    else:
-                        real_ioproc._log.warning("(%s) Unknown request id %d",
-                                                 real_ioproc.name, reqId)
+                    # Dispatch every response that is already complete,
+                    # instead of paying an epoll_wait round trip per
+                    # response.
+                    while responseReader.process():
+                        res = responseReader.pop()
+                        reqId = res['id']
+                        pendingReq = pendingRequests.pop(reqId, None)
+                        if pendingReq is not None:
+                            pendingReq.result = res
+                            pendingReq.event.set()
+                        else:
+                            real_ioproc._log.warning(
+                                "(%s) Unknown request id %d",
+                                real_ioproc.name, reqId)
 
                     continue
 
                 if fd == evtReciever:
-                    os.read(fd, 1)
+                    # Drain all pending wakeup bytes, coalescing a burst
+                    # of pings into a single queue sweep.
+                    os.read(fd, 4096)
                     if dataSender:
                         continue
 
-                    try:
-                        cmd, resObj = real_ioproc._commandQueue.get_nowait()
-                    except Empty:
+                    # Drain the whole queue and pipeline the requests into
+                    # one send buffer, instead of paying a full poll round
+                    # trip per command.
+                    buffers = []
+                    while True:
+                        try:
+                            cmd, resObj = \
+                                real_ioproc._commandQueue.popleft()
+                        except IndexError:
+                            break
+
+                        reqId = real_ioproc._getRequestId()
+                        pendingRequests[reqId] = resObj
+                        buffers.extend(real_ioproc._requestToBytes(cmd, reqId))
+
+                    if not buffers:
                         continue
 
-                    reqId = real_ioproc._getRequestId()
-                    pendingRequests[reqId] = resObj
-                    reqString = real_ioproc._requestToBytes(cmd, reqId)
-                    dataSender = DataSender(writePipe, reqString)
-                    poller.modify(writePipe, OUTPUT_READY_FLAGS)
+                    dataSender = DataSender(writePipe, buffers)
+                    # The pipe is typically writable; send right away and
+                    # wait for the next EPOLLOUT edge only if it fills up.
+                    if dataSender.process():
+                        dataSender = None
+                        real_ioproc._pingPoller()
                     continue
 
                 if fd == writePipe:
-                    if dataSender.process():
+                    if dataSender is not None and dataSender.process():
                         dataSender = None
-                        poller.modify(writePipe, ERROR_FLAGS)
                         real_ioproc._pingPoller()
     except:
         real_ioproc._log.exception("(%s) Communication thread failed",
@@ -164,6 +229,7 @@ def _communicate(ioproc_ref, proc, readPipe, writePipe):
             request.event.set()
 
     finally:
+        poller.close()
         os.close(readPipe)
         os.close(writePipe)
         if (evtReciever >= 0):
@@ -190,9 +256,10 @@ def dict2namedtuple(d, ntType):
 def NoIntrPoll(pollfun, timeout=-1):
     """
     This wrapper is used to handle the interrupt exceptions that might
-    occur during a poll system call. The wrapped function must be defined
-    as poll([timeout]) where the special timeout value 0 is used to return
-    immediately and -1 is used to wait indefinitely.
+    occur during an epoll_wait system call. The wrapped function must be
+    defined as poll([timeout]) taking the timeout in seconds, where the
+    special timeout value 0 is used to return immediately and -1 is used
+    to wait indefinitely.
     """
     # When the timeout < 0 we shouldn't compute a new timeout after an
     # interruption.
@@ -203,7 +270,7 @@ def NoIntrPoll(pollfun, timeout=-1):
 
     while True:
         try:
-            return pollfun(timeout * 1000)  # timeout for poll is in ms
+            return pollfun(timeout)
         except (IOError, error) as e:
             if e.args[0] != errno.EINTR:
                 raise
@@ -225,6 +292,23 @@ def setNonBlocking(fd):
     fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
 
+# Enlarged capacity for the data pipes; with the default 64 KiB a large
+# readfile/writefile payload needs many wakeup round trips.
+PIPE_CAPACITY = 1 << 20
+
+# fcntl.F_SETPIPE_SZ is available since python 3.10.
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+
+def enlargePipe(fd):
+    try:
+        fcntl.fcntl(fd, _F_SETPIPE_SZ, PIPE_CAPACITY)
+    except (IOError, OSError):
+        # Exceeding /proc/sys/fs/pipe-max-size for unprivileged users;
+        # the default capacity still works, just with more wakeups.
+        pass
+
+
 class CmdResult(object):
     def __init__(self):
         self.event = Event()
@@ -232,50 +316,120 @@ class CmdResult(object):
 
 
 class DataSender(object):
-    def __init__(self, fd, data):
+    def __init__(self, fd, buffers):
         self._fd = fd
-        self._dataPending = data
+        # Slicing a memoryview does not copy the data, so partial writes
+        # do not have to reallocate the remaining bytes on each call.
+        self._views = [memoryview(b) for b in buffers]
+        self._idx = 0
 
     def process(self):
-        if not self._dataPending:
-            return True
+        views = self._views
+        idx = self._idx
+        size = len(views)
+
+        # Keep writing until everything was sent or the pipe is full;
+        # with an edge-triggered poller we will not be woken up again
+        # while the pipe still has room.
+        while idx < size:
+            try:
+                # Scatter-gather write of the remaining buffers in one
+                # syscall, without concatenating them first, capped to
+                # what one writev may carry.
+                n = os.writev(self._fd, views[idx:idx + _IOV_MAX])
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    self._idx = idx
+                    return False
+
+                raise
 
-        n = os.write(self._fd, self._dataPending)
-        self._dataPending = self._dataPending[n:]
-        return False
+            while n > 0:
+                view = views[idx]
+                if n < len(view):
+                    views[idx] = view[n:]
+                    break
+
+                n -= len(view)
+                # Free the backing buffer promptly.
+                views[idx] = None
+                idx += 1
+
+        self._idx = idx
+        self._views = None
+        return True
 
 
 class ResponseReader(object):
     def __init__(self, fd):
         self._fd = fd
+        self._raw = io.FileIO(fd, "rb", closefd=False)
         self._responses = []
         self._dataRemaining = 0
-        self._dataBuffer = b''
+        self._buf = None
+        self._view = None
         self.timeout = 10
 
     def process(self):
         if self._dataRemaining == 0:
-            self._dataRemaining = Size.unpack(os.read(self._fd, Size.size))[0]
-
-        while True:
             try:
-                buff = os.read(self._fd, self._dataRemaining)
-                break
-            except OSError as e:
+                header = os.read(self._fd, Size.size)
+            except (IOError, OSError) as e:
                 if e.errno in (errno.EAGAIN, errno.EINTR):
-                    continue
+                    return False
 
                 raise
 
-        self._dataRemaining -= len(buff)
-        self._dataBuffer += buff
-        if self._dataRemaining == 0:
-            resObj = json.loads(self._dataBuffer.decode('utf8'))
-            self._responses.append(resObj)
-            self._dataBuffer = b''
-            return True
+            if not header:
+                return False
+
+            self._dataRemaining = Size.unpack(header)[0]
+            # Read the frame into a single preallocated buffer instead of
+            # concatenating chunks, which copies the accumulated data on
+            # every read.
+            self._buf = bytearray(self._dataRemaining)
+            self._view = memoryview(self._buf)
+            self._pos = 0
+
+        # Bind the loop state to locals; the per-iteration attribute
+        # lookups are measurable when thousands of small responses are
+        # framed per second.
+        readinto = self._raw.readinto
+        view = self._view
+        pos = self._pos
+        remaining = self._dataRemaining
+
+        while remaining:
+            try:
+                n = readinto(view[pos:] if pos else view)
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    n = None
+                else:
+                    raise
+
+            if not n:
+                # Would block (python 3) or the pipe was closed; wait for
+                # the next wakeup which will report an error event if the
+                # ioprocess died.
+                self._pos = pos
+                self._dataRemaining = remaining
+                return False
+
+            pos += n
+            remaining -= n
+
+        self._dataRemaining = 0
 
-        return False
+        resObj = _json_loads(self._buf)
+        self._responses.append(resObj)
+        self._view = None
+        self._buf = None
+        return True
 
     def pop(self):
         return self._responses.pop()
@@ -296,13 +450,24 @@ class IOProcess(object):
         self._max_queued_requests = max_queued_requests
         self._name = name or "ioprocess-%d" % next(self._counter)
         self._wait_until_ready = wait_until_ready
-        self._commandQueue = Queue()
-        self._eventFdReciever, self._eventFdSender = os.pipe()
-        self._reqId = 0
+        # deque.append and deque.popleft are atomic under the GIL, so no
+        # mutex or condition variable is needed; wakeups are delivered
+        # via the event fd anyway.
+        self._commandQueue = deque()
+        if _HAVE_EVENTFD:
+            # A single 8-byte kernel counter; concurrent pings coalesce
+            # in-kernel and are drained by one read, and it needs half
+            # the fds of a pipe.
+            self._eventFdReciever = self._eventFdSender = os.eventfd(
+                0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._eventFdReciever, self._eventFdSender = os.pipe()
+        # itertools.count increments in C, atomically under the GIL.
+        self._reqIdGen = itertools.count(1)
         self._isRunning = True
         self._started = Event()
         self._lock = Lock()
-        self._partialLogs = ""
+        self._partialLogs = bytearray()
         self._pid = None
 
         self._log.info("(%s) Starting client", self.name)
@@ -325,7 +490,7 @@ class IOProcess(object):
             # Python 3 creates fds with the close-on-exec flag set.
             clear_cloexec(fd)
 
-        self._partialLogs = ""
+        self._partialLogs = bytearray()
 
         cmd = [config.TASKSET_PATH,
                '--cpu-list', _ANY_CPU,
@@ -358,11 +523,17 @@ class IOProcess(object):
         setNonBlocking(myRead)
         setNonBlocking(myWrite)
 
+        enlargePipe(myRead)
+        enlargePipe(myWrite)
+
         self._startCommunication(p, myRead, myWrite)
 
     def _pingPoller(self):
         try:
-            os.write(self._eventFdSender, b'0')
+            if _HAVE_EVENTFD:
+                os.eventfd_write(self._eventFdSender, 1)
+            else:
+                os.write(self._eventFdSender, b'0')
         except OSError as e:
             if e.errno == errno.EAGAIN:
                 return
@@ -374,6 +545,10 @@ class IOProcess(object):
         self._log.debug("(%s) Starting communication thread", self.name)
         self._started.clear()
 
+        # The communication thread must never hold a strong reference
+        # to the client - not even indirectly through a bound method or
+        # a closure - or reference counting could not reclaim the client
+        # when the last user reference dies (see TestWeakref).
         args = (ref(self), proc, readPipe, writePipe)
         self._commthread = start_thread(
             _communicate,
@@ -388,62 +563,84 @@ class IOProcess(object):
                               self.name)
 
     def _getRequestId(self):
-        self._reqId += 1
-        return self._reqId
+        return next(self._reqIdGen)
+
+    # Requests without arguments (ping, memstat, crash) have a fixed
+    # shape and can be rendered from a template, skipping the dict
+    # allocation and the generic json encoder. Requests with arguments
+    # go through the encoder, which handles string escaping.
+    _NO_ARGS_TEMPLATE = '{"id":%d,"methodName":"%s","args":{}}'
+
+    # Payloads up to this size are framed into one preallocated buffer
+    # with the header - one allocation and one small memcpy. Larger
+    # payloads are kept separate so they are never copied; DataSender
+    # submits them as an iovec.
+    _FUSED_FRAME_LIMIT = 4096
 
     def _requestToBytes(self, cmd, reqId):
         methodName, args = cmd
-        reqDict = {'id': reqId,
-                   'methodName': methodName,
-                   'args': args}
+        if not args:
+            payload = (self._NO_ARGS_TEMPLATE
+                       % (reqId, methodName)).encode('ascii')
+        else:
+            reqDict = {'id': reqId,
+                       'methodName': methodName,
+                       'args': args}
 
-        reqStr = json.dumps(reqDict)
+            payload = _json_dumps(reqDict)
 
-        res = Size.pack(len(reqStr))
-        res += reqStr.encode('utf8')
+        size = len(payload)
+        if size <= self._FUSED_FRAME_LIMIT:
+            frame = bytearray(Size.size + size)
+            Size.pack_into(frame, 0, size)
+            frame[Size.size:] = payload
+            return (frame,)
 
-        return res
+        return Size.pack(size), payload
 
     def _processLogs(self, data):
         if self._partialLogs:
-            data = self._partialLogs + data
-            self._partialLogs = b''
+            # Extend the buffer in place instead of allocating a new
+            # bytes object per chunk. This was also initialized as str,
+            # mixing types with the bytes read from the pipe.
+            self._partialLogs.extend(data)
+            data = bytes(self._partialLogs)
+            del self._partialLogs[:]
         lines = data.splitlines(True)
         for line in lines:
             if not line.endswith(b"\n"):
-                self._partialLogs = line
+                self._partialLogs.extend(line)
                 return
 
-            # We must decode the line becuase python3 does not log bytes
-            # properly (e.g. you get "b'text'" intead of "text").
-            line = line.decode('utf8', 'replace')
-            try:
-                level, logDomain, message = line.strip().split("|", 2)
-            except:
+            match = _LOG_LINE_RE.match(line.strip())
+            if match is None:
                 self._log.warning("(%s) Invalid log message %r",
-                                  self.name, line)
+                                  self.name, line.decode('utf8', 'replace'))
+                continue
+
+            sublog = self._sublog
+            methodName, levelno = _LOG_METHODS[match.group(1)]
+            if not sublog.isEnabledFor(levelno):
+                # Skip the decode and formatting for levels the logger
+                # drops anyway (typically the DEBUG-heavy majority).
                 continue
 
-            if level == "ERROR":
-                self._sublog.error("(%s) %s", self.name, message)
-            elif level == "WARNING":
-                self._sublog.warning("(%s) %s", self.name, message)
-            elif level == "DEBUG":
-                self._sublog.debug("(%s) %s", self.name, message)
-            elif level == "INFO":
-                self._sublog.info("(%s) %s", self.name, message)
+            # We must decode the message becuase python3 does not log
+            # bytes properly (e.g. you get "b'text'" intead of "text").
+            message = match.group(2).decode('utf8', 'replace')
+            getattr(sublog, methodName)("(%s) %s", self.name, message)
 
     def _sendCommand(self, cmdName, args, timeout=None):
         res = CmdResult()
-        self._commandQueue.put(((cmdName, args), res))
+        self._commandQueue.append(((cmdName, args), res))
         self._pingPoller()
         res.event.wait(timeout)
         if not res.event.isSet():
-            raise Timeout(os.strerror(errno.ETIMEDOUT))
+            raise Timeout(_strerror(errno.ETIMEDOUT))
 
         if res.result.get('errcode', 0) != 0:
             errcode = res.result['errcode']
-            errstr = res.result.get('errstr', os.strerror(errcode))
+            errstr = res.result.get('errstr', _strerror(errcode))
 
             raise OSError(errcode, errstr)
 
@@ -538,6 +735,11 @@ class IOProcess(object):
                                  {"path": path, "mode": mode}, self.timeout)
 
     def readfile(self, path, direct=False):
+        # Large file data could move kernel-side with splice(2) over a
+        # dedicated data pipe, never entering the JSON message, but the
+        # child has no way to negotiate such a pipe in the current
+        # protocol, so the data travels through the regular response
+        # path.
         b64result = self._sendCommand("readfile",
                                       {"path": path,
                                        "direct": direct}, self.timeout)
@@ -545,9 +747,15 @@ class IOProcess(object):
         return b64decode(b64result)
 
     def writefile(self, path, data, direct=False):
+        # The wire protocol is shared with the C child, which expects and
+        # produces base64 file data inside the JSON message (see
+        # src/exported-functions.c). Moving the payload to a raw binary
+        # frame would avoid the base64 inflation, but requires a protocol
+        # change on both sides. Base64 output is pure ASCII, so decode it
+        # as such.
         self._sendCommand("writefile",
                           {"path": path,
-                           "data": b64encode(data).decode('utf8'),
+                           "data": b64encode(data).decode('ascii'),
                            "direct": direct},
                           self.timeout)
 
@@ -610,7 +818,8 @@ class IOProcess(object):
         self._log.info("(%s) Closing client", self.name)
         self._pingPoller()
         os.close(self._eventFdReciever)
-        os.close(self._eventFdSender)
+        if self._eventFdSender != self._eventFdReciever:
+            os.close(self._eventFdSender)
         if sync:
             self._log.debug("(%s) Waiting for communication thread", self.name)
             self._commthread.join()
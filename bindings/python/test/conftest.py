@@ -0,0 +1,63 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+import pytest
+
+from ioprocess import IOProcess
+
+
+@pytest.fixture(scope="session")
+def proc_factory():
+    """
+    Create IOProcess instances, caching them per configuration so every
+    unique (timeout, max_threads, max_queued_requests) combination is
+    built only once per session. All instances are closed at teardown;
+    tests that close the instance themselves must not use this.
+    """
+    cache = {}
+
+    def factory(timeout=10, max_threads=5, max_queued_requests=-1):
+        key = (timeout, max_threads, max_queued_requests)
+        if key not in cache:
+            cache[key] = IOProcess(
+                timeout=timeout,
+                max_threads=max_threads,
+                max_queued_requests=max_queued_requests)
+        return cache[key]
+
+    yield factory
+
+    for proc in cache.values():
+        proc.close()
+
+
+@pytest.fixture(scope="session")
+def proc(proc_factory):
+    """
+    Shared IOProcess instance for tests that do not need a special
+    configuration, amortizing the fork+exec+handshake cost across the
+    session. Crash tests may use it as well; the client restarts the
+    child automatically. Under pytest-xdist every worker runs its own
+    session, so each worker gets its own instance.
+    """
+    proc = proc_factory(timeout=30, max_threads=20)
+    # Health check - make sure the child is up before the first test.
+    proc.ping()
+    return proc